@@ -46,17 +46,29 @@ Data Structures
       Storage capacity
 """
 import argparse
+import cProfile
+import pstats
 import bisect
 import csv
+import gzip
+import hashlib
 import json
+import os
+import sqlite3
+import threading
+import time
 import boto3
 import pandas
 import locale
+import openpyxl
 import botocore
 import logging
-from collections import Counter
-from functools import lru_cache
+from collections import Counter, namedtuple
+from contextlib import closing, nullcontext
+from functools import lru_cache, partial, wraps
+from operator import itemgetter
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib import colors
@@ -64,16 +76,208 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.graphics.charts.piecharts import Pie
 from reportlab.graphics.shapes import Drawing
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+try:
+    # orjson parses the large Pricing API documents several times faster, the standard library parser is the fallback
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # ReportLab measures and writes text with the C functions of the optional rl_accel package when it is installed
+    import _rl_accel  # noqa: F401
+    RL_ACCEL = True
+except ImportError:
+    RL_ACCEL = False
+
+try:
+    # python-calamine parses the RVTools workbook several times faster, openpyxl in read-only mode is the fallback
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
 
 # These are the tabs we want to extract from the main xls file
 CPU = 'vCPU'
 DISK = 'vDisk'
 
+# The columns used from each tab. Each entry is matched by get_csv_column_title, to the first column whose title
+# contains one of the words.
+HOST_COLUMNS = (('CPUs',), ('Max',), ('VM',), ('OS according to the configuration file',))
+DISK_COLUMNS = (('Capacity MB', 'Capacity MiB', 'Capacity'), ('VM',))
+
+# All prices and instance types are looked up for this region. LOCATION is the name the Pricing API gives the same
+# region, change both together.
+REGION = 'us-east-1'
+LOCATION = 'US East (N. Virginia)'
+
+# The Pricing API is only served from a few regions, each of them returns the prices of every region
+PRICING_API_REGION = 'us-east-1'
+
+# The columns of the csv report, in the order they are written
+REPORT_FIELDNAMES = ('VM', 'Instance Type', 'Instance Cost', 'Storage', 'Storage Cost', 'Total', 'onDemand Cost',
+                     '1-Year Reserved', '3-Year Reserved', 'Total Cost')
+
+# The padding ReportLab leaves inside the body of every PDF page, on each side, in points
+PDF_FRAME_PADDING = 6
+
+# The height of the PDF host table rows, in points. Every cell holds a single line of 10 point text with the default
+# padding, the header has extra padding below it. Giving ReportLab the heights saves it measuring every cell.
+HOST_TABLE_ROW_HEIGHT = 18
+HOST_TABLE_HEADER_HEIGHT = 27
+
+# The widths of the PDF host table columns, in points
+HOST_TABLE_COL_WIDTHS = (60, 120, 80, 100, 100, 80)
+
+# The shortest time between two updates of the progress line, in seconds
+PROGRESS_INTERVAL = 0.1
+
+# Libraries whose log messages are kept at warnings or above, also with --verbose
+QUIET_LOGGERS = ('boto3', 'botocore', 'urllib3', 's3transfer')
+
+# The PDF styles are built once. The title gets its own style so the shared sample stylesheet is never modified.
+PDF_STYLES = getSampleStyleSheet()
+PDF_TITLE_STYLE = ParagraphStyle('QuoteTitle', parent=PDF_STYLES['Title'], alignment=1)  # Center the title
+HOST_TABLE_STYLE = (
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('BACKGROUND', (0, 0), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('FONTSIZE', (0, 0), (-1, -1), 10)  # Adjust font size
+)
+HOST_TABLE_HEADER_STYLE = (
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12)
+)
+HOST_TABLE_TOTAL_STYLE = (
+    ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),  # Highlight the total row
+)
+
+# Storage is priced per month, over the same 3 years as the reserved instances
+STORAGE_TERM_MONTHS = 36
+
+# The number of decimals the costs are written to the csv report with. On-demand prices are hourly and often below
+# a cent, so they keep a hundredth of a cent.
+COST_DIGITS = 2
+HOURLY_COST_DIGITS = 4
+
+# Pricing lookups are persisted between runs, AWS prices change rarely
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rv2aws')
+PRICING_CACHE_FILE = os.path.join(CACHE_DIR, 'pricing.sqlite')
+PRICING_CACHE_TTL = 86400  # One day, in seconds
+INSTANCE_TYPES_CACHE_FILE = os.path.join(CACHE_DIR, f'instance_types_{REGION}.json')
+INSTANCE_TYPES_CACHE_TTL = 86400
+refresh_pricing = False  # Set by --refresh-pricing to ignore cached prices
+
+# Local price catalog of the region. No catalog ships with the script, it is built with --build-pricing-catalog
+PRICING_CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'pricing_{REGION}.json.gz')
+live_pricing = False  # Set by --live-pricing to skip the local price catalog
+
+# The price tables are downloaded concurrently. Every client keeps enough connections open for that and backs off
+# adaptively when AWS throttles the requests.
+CLIENT_CONFIG = Config(max_pool_connections=64, retries={'mode': 'adaptive', 'max_attempts': 10})
+thread_local = threading.local()
+
+# Map the OS to AWS pricing categories
+OS_MAP = {
+    "CentOS": "Linux/UNIX",
+    "Red Hat": "Red Hat Enterprise Linux",
+    "Windows": "Windows",
+    "SUSE": "SUSE Linux",
+}
+
+# The reserved instance terms, in seconds
+RI_DURATIONS = {
+    "1-year Reserved": 31536000,
+    "3-year Reserved": 94608000,
+}
+
+# Map the Pricing API operatingSystem values to the same categories
+CATALOG_OS_MAP = {
+    "Linux": "Linux/UNIX",
+    "RHEL": "Red Hat Enterprise Linux",
+    "Windows": "Windows",
+    "SUSE": "SUSE Linux",
+}
+
+# Pricing API filters selecting the plain shared tenancy price of each instance type
+COMPUTE_INSTANCE_FILTERS = [
+    {'Type': 'TERM_MATCH', 'Field': 'productFamily', 'Value': 'Compute Instance'},
+    {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': LOCATION},
+    {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
+    {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'Used'},
+    {'Type': 'TERM_MATCH', 'Field': 'preInstalledSw', 'Value': 'NA'},
+    {'Type': 'TERM_MATCH', 'Field': 'licenseModel', 'Value': 'No License required'},
+]
+
+# Pricing API filters selecting the price of General Purpose storage
+STORAGE_FILTERS = [
+    {'Type': 'TERM_MATCH', 'Field': 'productFamily', 'Value': 'Storage'},
+    {'Type': 'TERM_MATCH', 'Field': 'volumeType', 'Value': 'General Purpose'},
+    {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': LOCATION},
+]
+
+# describe_reserved_instances_offerings arguments selecting the regional All Upfront standard reservations
+RESERVED_OFFERING_FILTERS = {
+    'OfferingType': 'All Upfront',
+    'OfferingClass': 'standard',
+    'IncludeMarketplace': False,
+    'Filters': [{'Name': 'scope', 'Values': ['Region']}],
+}
+
+# Cached prices are only valid for the region and filters they were looked up with, so all of them are part of
+# every cache key and changing any one starts from an empty cache
+PRICING_CACHE_SCOPE = hashlib.sha256(json.dumps(
+    [REGION, COMPUTE_INSTANCE_FILTERS, STORAGE_FILTERS, RESERVED_OFFERING_FILTERS]).encode()).hexdigest()
+
+
+def get_client(service_name):
+    """
+    Return a boto3 client for the current thread. boto3 sessions are not thread safe, so every thread builds its
+    clients from its own session once and reuses them.
+
+    :param service_name: The AWS service, e.g. 'pricing' or 'ec2'
+    :return: The client
+    """
+    if not hasattr(thread_local, 'clients'):
+        thread_local.session = boto3.session.Session()
+        thread_local.clients = {}
+    if service_name not in thread_local.clients:
+        region = PRICING_API_REGION if service_name == 'pricing' else REGION
+        thread_local.clients[service_name] = thread_local.session.client(service_name, region_name=region,
+                                                                         config=CLIENT_CONFIG)
+    return thread_local.clients[service_name]
+
+
+def file_cache(path, expire):
+    """
+    Save the JSON result of a function in a file and return it from there until the file is older than expire
+    seconds. The decorated function takes a refresh keyword to force a new call.
+
+    :param path: The cache file
+    :param expire: The number of seconds the file stays valid
+    :return: The decorator
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(refresh=False):
+            if not refresh and os.path.exists(path) and time.time() - os.path.getmtime(path) < expire:
+                with open(path) as cache_file:
+                    return json.load(cache_file)
+            value = func()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so that concurrent runs never read a partial file
+            with open(path + '.tmp', 'w') as cache_file:
+                json.dump(value, cache_file)
+            os.replace(path + '.tmp', path)
+            return value
+        return wrapper
+    return decorator
+
+
 # This script can only calculate pricing for the instance types in the table below
+@file_cache(INSTANCE_TYPES_CACHE_FILE, INSTANCE_TYPES_CACHE_TTL)
 def fetch_instance_types():
-    ec2 = boto3.client('ec2', region_name='us-east-1')
+    ec2 = get_client('ec2')
     paginator = ec2.get_paginator('describe_instance_types')
     types = []
     for page in paginator.paginate():
@@ -84,72 +288,102 @@ def fetch_instance_types():
                 "RAM": instance_type['MemoryInfo']['SizeInMiB'] / 1024
             })
     return types
-types = fetch_instance_types()
 
 
-def find_greater_than_or_equal(a, key):
+# The instance types as parallel columns rather than one dictionary per type
+InstanceTypeTable = namedtuple('InstanceTypeTable', ['names', 'cpus', 'rams'])
+
+
+def get_instance_type_table(instance_types):
     """
-     Find smallest item greater-than or equal to key.
-     Raise ValueError if no such item exists.
-     If multiple keys are equal, return the leftmost.
-     """
-    assert a and key
-    i = bisect.bisect_left(a, key)
-    if i == len(a):
-        raise ValueError('No item found with key at or above: %r' % (key,))
-    return a[i]
+    Convert the instance type records returned by fetch_instance_types into an InstanceTypeTable
+
+    :param instance_types: A list of {"type", "CPU", "RAM"} records
+    :return: The InstanceTypeTable
+    """
+    return InstanceTypeTable(
+        names=tuple(itype['type'] for itype in instance_types),
+        cpus=tuple(int(itype['CPU']) for itype in instance_types),
+        rams=tuple(float(itype['RAM']) for itype in instance_types))
+
 
-# Single host function for multi-threading
-def process_host(host, disks):
-    return find_aws_instance(host, disks)
+type_index = None  # (sorted CPU counts, sorted RAM sizes, size table), built by main
 
-def lookup_type(cpu, ram):
+
+def build_index(types):
+    """
+    Precompute the sorted CPU and RAM sizes of the instance types and group the instance types by their exact
+    (CPU, RAM) shape, so that per-host lookups never walk or sort the full type list. For every pair of a CPU and a
+    RAM size, the size table holds the instance types with that many CPUs and the smallest RAM size that is at least
+    as large.
+
+    :param types: The InstanceTypeTable
+    :return: A tuple of (sorted CPU counts, sorted RAM sizes, size table). The sizes are sorted here once so that
+             they can be bisected directly
+    """
+    assert types.names
+    bucket = {}
+    for name, cpu, ram in zip(types.names, types.cpus, types.rams):
+        bucket.setdefault((cpu, ram), []).append(name)
+    sorted_cpus = tuple(sorted(set(types.cpus)))
+    sorted_rams = tuple(sorted(set(types.rams)))
+
+    # Walk down the RAM sizes of each CPU count, so every size inherits the next larger shape that exists
+    size_table = {}
+    for cpu in sorted_cpus:
+        fitting = []
+        for ram in reversed(sorted_rams):
+            fitting = bucket.get((cpu, ram), fitting)
+            size_table[(cpu, ram)] = fitting
+    return sorted_cpus, sorted_rams, size_table
+
+
+def disk_cache(expire):
     """
-    Given CPU and RAM requirements, return the instance type which matches those
-    requirements
+    Persist the results of a function in an sqlite database, keyed by the pricing scope, the function name and its
+    arguments.
+    Empty results are not stored so failed lookups are retried on the next run.
 
-    :param cpu: The number of CPUs
-    :param ram: The size of RAM
-    :return: A list of instances which meet the above requirements
+    :param expire: The number of seconds a stored result stays valid
+    :return: The decorator
     """
-    global types
-    assert cpu and ram
-    instances = []
-    for itype in sorted(types, key=lambda i: (int(i['CPU']), int(i['RAM']))):
-        if itype['CPU'] == cpu and itype['RAM'] == ram:
-            instances.append(itype['type'])
-    return instances
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            key = json.dumps([PRICING_CACHE_SCOPE, func.__name__, args])
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with closing(sqlite3.connect(PRICING_CACHE_FILE, timeout=30)) as db:
+                db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL)')
+                if not refresh_pricing:
+                    row = db.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+                    if row and time.time() - row[1] < expire:
+                        return json_loads(row[0])
+            value = func(*args)
+            if value:
+                with closing(sqlite3.connect(PRICING_CACHE_FILE, timeout=30)) as db, db:
+                    db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
+            return value
+        return wrapper
+    return decorator
+
+# Price a single host
+def process_host(host, disks_by_vm):
+    return find_aws_instance(host, disks_by_vm)
 
 @lru_cache(maxsize=None) # Unbounded cache
+@disk_cache(PRICING_CACHE_TTL)
 def get_storage_cost():
     """
-    Return the price per unit storage cost for us-east-1
+    Return the price per unit storage cost for the region
     :return: Cost in US Dollars
     """
     price = 0
-    pricing = boto3.client('pricing', region_name='us-east-1')
-    response = pricing.get_products(
-        ServiceCode='AmazonEC2',
-        Filters=[
-            {
-                "Type": "TERM_MATCH",
-                "Field": "productFamily",
-                "Value": "Storage"
-            },
-            {
-                'Type': 'TERM_MATCH',
-                'Field': 'volumeType',
-                'Value': 'General Purpose'
-            },
-            {
-                'Type': 'TERM_MATCH',
-                'Field': 'location',
-                'Value': 'US East (N. Virginia)'
-            }])
+    pricing = get_client('pricing')
+    response = pricing.get_products(ServiceCode='AmazonEC2', Filters=STORAGE_FILTERS)
     
     # Iterate through the pricelist and extract the price
     for pricelist_item in response['PriceList']:
-        price_info = json.loads(pricelist_item)
+        price_info = json_loads(pricelist_item)
         for on_demand in price_info["terms"]["OnDemand"].keys():
             for price_dimension in price_info["terms"]["OnDemand"][on_demand]["priceDimensions"]:
                 price = price_info["terms"]["OnDemand"][on_demand]["priceDimensions"][price_dimension]["pricePerUnit"]
@@ -178,9 +412,7 @@ def get_minimum_ram_size():
 
     :return: The smallest RAM size
     """
-    global types
-    sorted_ram_types = sorted(types, key=lambda i: float(i['RAM']))
-    return float(sorted_ram_types[0]['RAM'])
+    return type_index[1][0]
 
 
 def get_minimum_cpu_size():
@@ -189,25 +421,7 @@ def get_minimum_cpu_size():
 
     :return: The smallest count of CPUs
     """
-    global types
-    sorted_cpu_types = sorted(types, key=lambda i: int(i['CPU']))
-    return int(sorted_cpu_types[0]['CPU'])
-
-
-def get_next_ram_size(sizes, ram):
-    """
-    Get the next largest RAM size from our list of sorted RAM sizes
-
-    :param sizes: A set of sorted ram sizes
-    :param ram: The current RAM size
-    :return: The next larger RAM size
-    """
-    assert ram and sizes
-    current = sizes.index(ram)
-    current += 1
-    # print("ram = " + str(ram) + " len = " + str(len(sizes)) + " current " + str(current))
-    assert int(len(sizes)) > int(current)
-    return sizes[current]
+    return type_index[0][0]
 
 
 def get_correct_instance_size(cpu, ram):
@@ -219,103 +433,194 @@ def get_correct_instance_size(cpu, ram):
     :return: The correct instance types that matches the RAM/CPU requirement
     """
     assert cpu and ram
-    found = []
+    sorted_cpus, sorted_rams, size_table = type_index
+    # Find the smallest CPU count and RAM size that are at least as large as the requirement
+    cpu_index = bisect.bisect_left(sorted_cpus, int(cpu))
+    ram_index = bisect.bisect_left(sorted_rams, float(ram))
+    if cpu_index == len(sorted_cpus) or ram_index == len(sorted_rams):
+        return []
+    return size_table[(sorted_cpus[cpu_index], sorted_rams[ram_index])]
+
 
-    min_cpu = find_greater_than_or_equal(extract_list_from_instance_types('CPU'), int(cpu))
-    sorted_ram_size = extract_list_from_instance_types('RAM')
-    min_ram = find_greater_than_or_equal(sorted_ram_size, float(ram))
+def build_pricing_catalog(output_file):
+    """
+    Download the on-demand and All Upfront reserved prices of every instance type and save them as the local price
+    catalog, a gzipped JSON file keyed by "instance type|OS|pricing model"
+
+    :param output_file: The catalog file to write
+    :return: The number of prices written
+    """
+    assert output_file
+    pricing = get_client('pricing')
+    paginator = pricing.get_paginator('get_products')
+    catalog = {}
+    for page in paginator.paginate(ServiceCode='AmazonEC2', Filters=COMPUTE_INSTANCE_FILTERS):
+        for pricelist_item in page['PriceList']:
+            price_info = json_loads(pricelist_item)
+            attributes = price_info['product']['attributes']
+            os_type = CATALOG_OS_MAP.get(attributes.get('operatingSystem'))
+            if not os_type:
+                continue
+            key = attributes['instanceType'] + '|' + os_type + '|'
+            for term in price_info['terms'].get('OnDemand', {}).values():
+                for price_dimension in term['priceDimensions'].values():
+                    catalog[key + 'onDemand'] = float(price_dimension['pricePerUnit']['USD'])
+            for term in price_info['terms'].get('Reserved', {}).values():
+                term_attributes = term['termAttributes']
+                if term_attributes.get('PurchaseOption') != 'All Upfront' or \
+                        term_attributes.get('OfferingClass', 'standard') != 'standard':
+                    continue
+                pricing_model = {'1yr': '1-year Reserved', '3yr': '3-year Reserved'}.get(
+                    term_attributes.get('LeaseContractLength'))
+                for price_dimension in term['priceDimensions'].values():
+                    if pricing_model and price_dimension.get('unit') == 'Quantity':
+                        catalog[key + pricing_model] = float(price_dimension['pricePerUnit']['USD'])
+
+    # Write to a temporary file first so an interrupted download never leaves a truncated catalog
+    with gzip.open(output_file + '.tmp', 'wt', encoding='utf-8') as catalog_file:
+        json.dump(catalog, catalog_file)
+    os.replace(output_file + '.tmp', output_file)
+    return len(catalog)
+
+
+@lru_cache(maxsize=None)
+def load_pricing_catalog():
+    """
+    Load the local price catalog next to this script, if one has been built with --build-pricing-catalog
 
-    while not found:
-        found = lookup_type(min_cpu, min_ram)
-        min_ram = find_greater_than_or_equal(sorted_ram_size, get_next_ram_size(list(sorted_ram_size), min_ram))
-        # print("min cpu: " + str(min_cpu) + " min ram: " + str(min_ram))
-    return found
+    :return: A dictionary of prices keyed by (instance type, OS, pricing model), empty if there is no catalog
+    """
+    if not os.path.exists(PRICING_CATALOG_FILE):
+        logging.info(f"No pricing catalog found at {PRICING_CATALOG_FILE}, using the AWS pricing API")
+        return {}
+    with gzip.open(PRICING_CATALOG_FILE, 'rt', encoding='utf-8') as catalog_file:
+        return {tuple(key.split('|')): price for key, price in json.load(catalog_file).items()}
 
 
-def get_aws_os_type(os):
+@lru_cache(maxsize=256)
+def map_os_type(os):
     """
-    Return the correct OS type for a pricing lookup
+    Return the AWS pricing OS category for a raw OS string
 
     :param os: The raw OS type
-    :return: The appropriate type for a pricing lookup
+    :return: The OS category used for pricing lookups
     """
-    assert os
-    if 'Windows' in os:
-        return 'Windows'
-    return "Linux/UNIX"
+    return next((v for k, v in OS_MAP.items() if k in os), "Linux/UNIX")
 
 
-# Get current AWS price for an onDemand instance
-@lru_cache(maxsize=None) # Unbounded cache
-def get_price(instance, os, pricing_model):
-    pricing = boto3.client('pricing', region_name='us-east-1')
-    ec2 = boto3.client('ec2', region_name='us-east-1')
-    
-    # Map the OS to AWS pricing categories
-    os_map = {
-        "CentOS": "Linux/UNIX",
-        "Red Hat": "Red Hat Enterprise Linux",
-        "Windows": "Windows",
-        "SUSE": "SUSE Linux",
-    }
-    
-    os_type = next((v for k, v in os_map.items() if k in os), "Linux/UNIX")
+@lru_cache(maxsize=None)
+@disk_cache(PRICING_CACHE_TTL)
+def load_on_demand_table(os_type):
+    """
+    Fetch the on-demand price of every instance type for an OS, paging through the Pricing API once instead of
+    querying each instance type
 
-    if pricing_model == "onDemand":
-        try:
-            response = pricing.get_products(
-                ServiceCode='AmazonEC2',
-                Filters=[
-                    {'Type': 'TERM_MATCH', 'Field': 'instanceType', 'Value': instance},
-                    {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': os_type},
-                    {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': 'US East (N. Virginia)'},
-                    {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
-                    {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'Used'},
-                ]
-            )
-
-            if 'PriceList' in response and response['PriceList']:
-                price_info = json.loads(response['PriceList'][0])
-                on_demand_prices = price_info.get('terms', {}).get('OnDemand', {})
-                if on_demand_prices:
-                    price_dimension = next(iter(next(iter(on_demand_prices.values())).get('priceDimensions', {}).values()))
-                    price_per_unit = price_dimension.get('pricePerUnit', {}).get('USD', 0.0)
-                    return float(price_per_unit)
-            
-            logging.warning(f"No pricing information found for {instance} with OS {os_type}")
-            return 0.0
-
-        except botocore.exceptions.ClientError as e:
-            logging.error(f"API error for instance {instance}: {str(e)}")
-            return 0.0
-
-    else:  # For 1-year and 3-year Reserved instances
-        offering_type = "All Upfront"
-        min_duration = 31536000 if pricing_model == "1-year Reserved" else 94608000
+    :param os_type: The AWS pricing OS category
+    :return: A dictionary of instance type to hourly price
+    """
+    pricing = get_client('pricing')
+    paginator = pricing.get_paginator('get_products')
+    # The Pricing API names the operating systems differently from the EC2 product descriptions
+    operating_system = next((k for k, v in CATALOG_OS_MAP.items() if v == os_type), os_type)
+    prices = {}
+    for page in paginator.paginate(
+            ServiceCode='AmazonEC2',
+            Filters=COMPUTE_INSTANCE_FILTERS + [
+                {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': operating_system}]):
+        for pricelist_item in page['PriceList']:
+            price_info = json_loads(pricelist_item)
+            instance = price_info['product']['attributes'].get('instanceType')
+            for term in price_info['terms'].get('OnDemand', {}).values():
+                for price_dimension in term['priceDimensions'].values():
+                    prices[instance] = float(price_dimension['pricePerUnit']['USD'])
+    return prices
+
+
+@lru_cache(maxsize=None)
+@disk_cache(PRICING_CACHE_TTL)
+def load_ri_table(os_type, duration):
+    """
+    Fetch the All Upfront standard reserved price of every instance type for an OS and term, paging through
+    describe_reserved_instances_offerings once instead of querying each instance type
 
-        try:
-            resp = ec2.describe_reserved_instances_offerings(
-                InstanceType=instance,
-                ProductDescription=os_type,
-                OfferingType=offering_type,
-                MinDuration=min_duration,
-                MaxResults=100,
-            )
-
-            if 'ReservedInstancesOfferings' in resp and resp['ReservedInstancesOfferings']:
-                reserved_instance = resp['ReservedInstancesOfferings'][0]
-                return float(reserved_instance.get('FixedPrice', 0.0))
-
-            logging.warning(f"No reserved instance offerings found for {instance} with OS {os_type}")
-            return 0.0
-
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'InvalidParameterValue':
-                logging.warning(f"Invalid instance type or OS: {instance}, {os_type}")
-            else:
-                logging.error(f"API error for reserved instance {instance}: {str(e)}")
-            return 0.0
+    :param os_type: The AWS pricing OS category
+    :param duration: The reservation term in seconds
+    :return: A dictionary of instance type to upfront price
+    """
+    ec2 = get_client('ec2')
+    paginator = ec2.get_paginator('describe_reserved_instances_offerings')
+    prices = {}
+    for page in paginator.paginate(
+            ProductDescription=os_type,
+            MinDuration=duration,
+            MaxDuration=duration,
+            **RESERVED_OFFERING_FILTERS):
+        for offering in page['ReservedInstancesOfferings']:
+            if offering.get('OfferingType') != 'All Upfront':
+                continue
+            # Keep the first offering of each type, like the single instance lookup did
+            prices.setdefault(offering['InstanceType'], float(offering.get('FixedPrice', 0.0)))
+    return prices
+
+
+def prefetch_prices(instances, os_types, threads):
+    """
+    Load the price tables of every OS and pricing model the candidate instance types need, so that they are in
+    memory before the hosts are priced. The tables are downloaded concurrently, and the ones the pricing catalog
+    fully covers are skipped.
+
+    :param instances: The candidate instance types
+    :param os_types: The AWS pricing OS categories in use
+    :param threads: The number of tables to download at the same time
+    """
+    catalog = {} if live_pricing else load_pricing_catalog()
+    tables = [(os_type, pricing_model)
+              for os_type in os_types
+              for pricing_model in ["onDemand", "1-year Reserved", "3-year Reserved"]
+              if not all((instance, os_type, pricing_model) in catalog for instance in instances)]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in as_completed([executor.submit(load_price_table, *table) for table in tables]):
+            future.result()
+
+
+@lru_cache(maxsize=None)
+def load_price_table(os_type, pricing_model):
+    """
+    Return the prices of every instance type for an OS and pricing model. A table that fails to download is
+    remembered as empty, so its instance types are reported as missing a price rather than downloading it again for
+    each of them.
+
+    :param os_type: The AWS pricing OS category
+    :param pricing_model: onDemand, 1-year Reserved or 3-year Reserved
+    :return: A dictionary of instance type to price
+    """
+    try:
+        if pricing_model == "onDemand":
+            return load_on_demand_table(os_type)
+        return load_ri_table(os_type, RI_DURATIONS[pricing_model])
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        # BotoCoreError covers the failures before AWS answers, such as missing credentials or no connection
+        logging.error(f"API error loading {pricing_model} prices for {os_type}: {str(e)}")
+        return {}
 
+
+# Get current AWS price for an instance
+def get_price(instance, os, pricing_model):
+    # Normalize the OS first so that equivalent OS strings share cache entries
+    os_type = map_os_type(os)
+    if not live_pricing:
+        price = load_pricing_catalog().get((instance, os_type, pricing_model))
+        if price:
+            return price
+    return get_price_for_os_type(instance, os_type, pricing_model)
+
+
+@lru_cache(maxsize=None) # Unbounded cache
+def get_price_for_os_type(instance, os_type, pricing_model):
+    price = load_price_table(os_type, pricing_model).get(instance)
+    if price:
+        return price
+    logging.warning(f"No {pricing_model} pricing information found for {instance} with OS {os_type}")
     return 0.0
 
 
@@ -338,37 +643,38 @@ def get_least_expensive_option(instances, os, pricing_model, invalid_instance_ty
         else:
             prices[instance] = price
 
-    sorted_prices = sorted([(k, v) for k, v in prices.items() if v is not None], key=lambda x: int(x[1]))
-
-    if sorted_prices:
-        return {"Instance Type": sorted_prices[0][0], "Instance Cost": int(sorted_prices[0][1])}, invalid_instances
+    if prices:
+        # Compare the exact prices, hourly on-demand prices are usually well below a dollar
+        instance, price = min(prices.items(), key=itemgetter(1))
+        return {"Instance Type": instance, "Instance Cost": price}, invalid_instances
     else:
         logging.warning(f"No valid prices found for instances: {instances}, OS: {os}, pricing model: {pricing_model}")
         return {"Instance Type": None, "Instance Cost": None}, invalid_instances
 
-def get_three_year_storage_cost(host, disks):
+def get_disk_capacity_by_vm(disks):
+    """
+    Add up the capacity of all disks of each VM
+
+    :param disks: A table of storage records, see get_storage_table
+    :return: A dictionary of VM name to total capacity in megabytes
+    """
+    return disks.groupby('VM', sort=False)['Capacity'].sum().to_dict()
+
+
+def get_three_year_storage_cost(host, disks_by_vm):
     """
     Given a host record, return the record with storage costs appended
 
     :param host: A host record
-    :param disks: A collection of storage disk values to use for price calculations
+    :param disks_by_vm: The total disk capacity of each VM, see get_disk_capacity_by_vm
     :return: The host record with storage costs added
     """
-    assert host and disks
+    assert host and disks_by_vm
     price_per_gb_month = get_storage_cost()
-    vm = host['VM']
-    mbytes = 0
-    # print(vm)
-    for disk in disks:
-        if disk['VM'] == vm:
-            mbytes = int(str(disk['Capacity']).replace(',', ''))
+    mbytes = disks_by_vm.get(host['VM'], 0)
     # Convert to gigabytes
-    gbytes = int(mbytes) / 1000
-    monthly_cost = '%.2f' % (float(float(price_per_gb_month) * float(gbytes)))
-    yearly_cost = float(monthly_cost) * 12
-    three_year_cost = '%.2f' % (float(yearly_cost) * 3)
-    # print("vm = " + str(vm) + " storage = " + str(gbytes) + " (GB) cost = " + str(monthly_cost))
-    return {"Storage": gbytes, "Storage Cost": float(three_year_cost)}
+    gbytes = mbytes / 1000
+    return {"Storage": gbytes, "Storage Cost": price_per_gb_month * gbytes * STORAGE_TERM_MONTHS}
 
 
 def get_total_cost(host):
@@ -381,25 +687,26 @@ def get_total_cost(host):
     assert host
     instance_cost = float(host["Instance Cost"]) if host["Instance Cost"] is not None else 0.0
     storage_cost = float(host["Storage Cost"]) if host["Storage Cost"] is not None else 0.0
-    total = '%.2f' % (instance_cost + storage_cost)
-    return {"Total": float(total)}
+    return {"Total": instance_cost + storage_cost}
 
 
-def find_aws_instance(host, disks):
-    if not host:
-        logging.error("Empty host record provided")
-        return None
-    if 'CPUs' not in host or 'RAM' not in host:
-        logging.error(f"Invalid host record: {host}")
-        return None
+@lru_cache(maxsize=None)
+def resolve_host_shape(cpu, ram, os):
+    """
+    Pick the instance type and its prices for a host shape. Many hosts in an RVTools report share the same shape,
+    so the result is cached and shared by all of them.
 
-    cpu = host['CPUs']
-    ram = host['RAM']
+    :param cpu: The number of CPUs
+    :param ram: The size of RAM
+    :param os: The raw OS type
+    :return: A tuple of a dictionary with the Instance Type, Instance Cost and Cost Details, or None if no instance
+             fits, and the instance types without a price, once for each pricing model they are missing from
+    """
     instances = get_correct_instance_size(cpu, ram)
-    
+
     if not instances:
         logging.warning(f"No suitable instances found for CPU: {cpu}, RAM: {ram}")
-        return None
+        return None, ()
 
     pricing_models = ["onDemand", "1-year Reserved", "3-year Reserved"]
     cost_details = {}
@@ -407,224 +714,358 @@ def find_aws_instance(host, disks):
     all_invalid_instances = []
 
     for pricing_model in pricing_models:
-        type_and_cost, invalid_instances = get_least_expensive_option(instances, host.get('OS'), pricing_model, invalid_instance_types_count)
+        type_and_cost, invalid_instances = get_least_expensive_option(instances, os, pricing_model, invalid_instance_types_count)
         all_invalid_instances += invalid_instances
         cost_details[pricing_model] = type_and_cost
 
-    host_with_type_cost = {**host, **cost_details["3-year Reserved"]}
-    storage_cost = get_three_year_storage_cost(host, disks)
+    return {**cost_details["3-year Reserved"], "Cost Details": cost_details}, tuple(all_invalid_instances)
+
+
+def find_aws_instance(host, disks_by_vm):
+    if not host:
+        logging.error("Empty host record provided")
+        return None
+    if 'CPUs' not in host or 'RAM' not in host:
+        logging.error(f"Invalid host record: {host}")
+        return None
+
+    shape, _ = resolve_host_shape(host['CPUs'], host['RAM'], host.get('OS'))
+    if shape is None:
+        return None
+
+    host_with_type_cost = {**host, **shape}
+    storage_cost = get_three_year_storage_cost(host, disks_by_vm)
     host_with_storage_cost = {**host_with_type_cost, **storage_cost}
     total_cost = get_total_cost(host_with_storage_cost)
-    host_with_cost_details = {**host_with_storage_cost, **total_cost, "Cost Details": cost_details}
+    host_with_cost_details = {**host_with_storage_cost, **total_cost}
 
     return host_with_cost_details
 
 
-def extract_list_from_instance_types(key):
+def get_host_records(data):
+    """
+    Given a table of host information with the columns of the RVTools vCPU tab, convert it into host records
+
+    :param data: A DataFrame of strings
+    :return: The list of host records
+    """
+    min_cpu = get_minimum_cpu_size()
+    min_ram = get_minimum_ram_size()
+    columns = list(data.columns)
+    try:
+        cpu_count_column, ram_column, vm_column, os_column = (
+            columns[get_csv_column_title(columns, *titles)] for titles in HOST_COLUMNS)
+    except ValueError as e:
+        raise ValueError(f"{str(e)}. Available columns: {', '.join(data.attrs.get('tab_header', columns))}") from e
+
+    # Set the minimum acceptable values so we can pick the correct instance types. RAM is given in thousands
+    # of megabytes and may contain commas, convert it to gigabytes
+    cpus = pandas.to_numeric(data[cpu_count_column].str.replace(',', '')).astype(int).clip(lower=min_cpu)
+    ram = (pandas.to_numeric(data[ram_column].str.replace(',', '')) / 1000).round().astype(float).clip(lower=min_ram)
+    hosts = pandas.DataFrame({
+        "CPUs": cpus,
+        "RAM": ram,
+        "VM": data[vm_column],
+        "OS": data[os_column]
+    })
+    return hosts.to_dict('records')
+
+
+def get_storage_table(data):
     """
-    Given a key, return a list of sorted values for that key
+    Given a table of storage information with the columns of the RVTools vDisk tab, convert it into a table of
+    storage records
 
-    :param key: Either 'CPU' or 'RAM'
-    :return: A sorted list of the values found for that key
+    :param data: A DataFrame of strings
+    :return: A DataFrame with the VM and Capacity columns, or None if a column is missing
     """
-    assert key
-    global types
-    values = set()
-    for instance_type in types:
-        values.add(instance_type[key])
-    return sorted(values)
+    columns = list(data.columns)
+    try:
+        capacity_column, vm_column = (columns[get_csv_column_title(columns, *titles)] for titles in DISK_COLUMNS)
+    except ValueError as e:
+        print(f"Warning: {str(e)}. Available columns: {', '.join(data.attrs.get('tab_header', columns))}")
+        print("Skipping storage records due to missing column.")
+        return None
 
+    # Disks without a capacity do not add any storage
+    capacity = pandas.to_numeric(data[capacity_column].str.replace(',', ''), errors='coerce').fillna(0).astype(int)
+    return pandas.DataFrame({
+        "Capacity": capacity,
+        "VM": data[vm_column]
+    })
 
-def set_minimum_ram_size_for_instance(ram):
+
+def open_workbook(excel_file):
     """
-    Given a ram size in thousands of megabytes, in string form, and containing commas, refactor it to a single
-    float value in gigabytes
+    Open an excel file for reading its tabs with read_excel_tab. The file is read with python-calamine when it is
+    installed, otherwise it is streamed with openpyxl in read-only mode.
 
-    :param ram: The string values representing thousands of megabytes
-    :return: The minimum acceptable size or the initial value, whichever is larger
+    :param excel_file: The input excel file
+    :return: The open workbook, to be closed by the caller
     """
-    min_ram = get_minimum_ram_size()
-    gig_ram = float(round(int(ram)/1000))
-    return float(gig_ram if gig_ram > min_ram else min_ram)
+    assert excel_file
+    if CalamineWorkbook is not None:
+        return CalamineWorkbook.from_path(excel_file)
+    return openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
 
 
-def load_host_records_from_csv(input_csv):
+def get_cell_text(value):
     """
-    Given a csv file of host information, load it into a list
+    Return the text of a cell value as a CSV export would contain it. calamine reads every number as a float, whole
+    numbers are written without a fraction so they look the same as when read by openpyxl.
 
-    :param input_csv: The input CSV file
-    :return: The list of host records
+    :param value: The cell value
+    :return: The cell text, an empty string for an empty cell
     """
-    assert input_csv
-    min_cpu = get_minimum_cpu_size()
-    row_count = 0
-    hosts = []
-    with open(input_csv, mode='r') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            if row_count == 0:
-                cpu_count_column = get_csv_column_title(row, 'CPUs')
-                ram_column = get_csv_column_title(row, 'Max')
-                vm_column = get_csv_column_title(row, 'VM')
-                os_column = get_csv_column_title(row, 'OS according to the configuration file')
-                row_count += 1
-                continue
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
 
-            hosts.append({
-                # Set the minimum acceptable values so we can pick the correct instance types
-                "CPUs": int(min_cpu if int(row[cpu_count_column]) < min_cpu else row[cpu_count_column]),
-                "RAM": set_minimum_ram_size_for_instance(row[ram_column]),
-                "VM": row[vm_column],
-                "OS": row[os_column]
-            })
-    return hosts
-
-
-def load_storage_records_from_csv(input_csv):
-    """
-    Given a csv file with storage information, load it into a list
-
-    :param input_csv: The input csv file
-    :return: A list of storage records
-    """
-    assert input_csv
-    disk_row_count = 0
-    disks = []
-    with open(input_csv) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            if disk_row_count == 0:
-                try:
-                    capacity_column = get_csv_column_title(row, 'Capacity MB', 'Capacity MiB', 'Capacity')
-                    vm_column = get_csv_column_title(row, 'VM')
-                except ValueError as e:
-                    print(f"Warning: {str(e)}. Available columns: {', '.join(row)}")
-                    print("Skipping storage records due to missing column.")
-                    return []
-                disk_row_count += 1
-                continue
 
-            disks.append({
-                "Capacity": row[capacity_column],
-                "VM": row[vm_column]
-            })
-    return disks
+def read_excel_tab(workbook, tab_name, columns, csv_writer=None):
+    """
+    Read a tab of an open workbook into a table of strings, the same values a CSV export of the tab would contain.
+    Empty cells become empty strings, and rows without any value are skipped like read_excel does. Only the cells of
+    the wanted columns are converted.
+
+    :param workbook: A workbook opened with open_workbook
+    :param tab_name: The name of the tab to read
+    :param columns: Only keep the columns matching these titles, see HOST_COLUMNS. Titles without a matching
+                    column are left out.
+    :param csv_writer: Optionally a csv writer that every row is also written to, with all of its columns
+    :return: A DataFrame of strings. The titles of all the columns of the tab are kept in its 'tab_header'
+             attribute, for the error messages about missing columns.
+    """
+    if isinstance(workbook, openpyxl.Workbook):
+        if tab_name not in workbook.sheetnames:
+            raise ValueError(f"Worksheet named '{tab_name}' not found")
+        rows = workbook[tab_name].iter_rows(values_only=True)
+    else:
+        if tab_name not in workbook.sheet_names:
+            raise ValueError(f"Worksheet named '{tab_name}' not found")
+        rows = iter(workbook.get_sheet_by_name(tab_name).iter_rows())
+    header = [get_cell_text(value) for value in next(rows, ())]
+    indexes = set()
+    for titles in columns:
+        try:
+            indexes.add(get_csv_column_title(header, *titles))
+        except ValueError:
+            pass
+    indexes = sorted(indexes)
+
+    # Blank rows, for example formatted cells below the data, have no values
+    rows = (row for row in rows if any(value is not None and value != '' for value in row))
+    if csv_writer is None:
+        table = [[get_cell_text(row[index]) if index < len(row) else '' for index in indexes] for row in rows]
+    else:
+        csv_writer.writerow(header)
+        table = []
+        for row in rows:
+            values = [get_cell_text(value) for value in row[:len(header)]]
+            values += [''] * (len(header) - len(values))
+            csv_writer.writerow(values)
+            table.append([values[index] for index in indexes])
 
+    data = pandas.DataFrame(table, columns=[header[index] for index in indexes])
+    data.attrs['tab_header'] = header
+    return data
 
-def write_report_file_to_csv(output_csv, hosts, disks, fieldnames):
-    assert output_csv and hosts and disks
-    total_on_demand = total_one_year = total_three_year = 0
 
-    with open(output_csv, mode='w', newline='') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
-        for host in hosts:
-            instance = find_aws_instance(host, disks)
-            row = {
-                'VM': instance['VM'],
-                'Instance Type': instance['Instance Type'],
-                'Instance Cost': instance['Instance Cost'],
-                'Storage': instance['Storage'],
-                'Storage Cost': instance['Storage Cost'],
-                'Total': instance['Total'],
-                'onDemand Cost': instance['Cost Details']['onDemand']['Instance Cost'],
-                '1-Year Reserved': instance['Cost Details']['1-year Reserved']['Instance Cost'],
-                '3-Year Reserved': instance['Cost Details']['3-year Reserved']['Instance Cost'],
-                'Total Cost': instance['Total']
-            }
-            writer.writerow(row)
-
-            # Check if any of the costs are None and add them to the total only if they are not
-            total_on_demand += row['onDemand Cost'] if row['onDemand Cost'] is not None else 0
-            total_one_year += row['1-Year Reserved'] if row['1-Year Reserved'] is not None else 0
-            total_three_year += row['Total Cost'] if row['Total Cost'] is not None else 0
-
-        # Write totals to CSV
-        writer.writerow({
-            'VM': 'Total',
-            'Instance Type': '',
-            'onDemand Cost': total_on_demand,
-            '1-Year Reserved': total_one_year,
-            '3-Year Reserved': total_three_year,
-            'Total Cost': total_three_year
-        })
-
-
-def excel_to_csv(excel_file, tab_name, output_csv_file):
-    """
-    Given an excel file and a tab name in it, generate an output csv file from that tab.
+def read_excel_tabs(excel_file, *tabs, csv_files=None):
+    """
+    Read tabs of an excel file into tables of strings. The workbook is opened once with open_workbook rather than
+    loaded as a whole by openpyxl.
 
     :param excel_file: The input excel file
-    :param tab_name: The name of the tab you wish to have exported
-    :param output_csv_file: The name of the output csv file where the tab is exported
+    :param tabs: (tab name, column titles) pairs, see read_excel_tab
+    :param csv_files: Optionally a csv file for each tab, the rows are copied there with all of their columns while
+                      the tab is read
+    :return: A list of DataFrames of strings, one per tab, see read_excel_tab
     """
-    assert excel_file and tab_name and output_csv_file
+    assert excel_file and tabs
+    assert csv_files is None or len(csv_files) == len(tabs)
+    workbook = open_workbook(excel_file)
+    try:
+        tables = []
+        for index, (tab_name, columns) in enumerate(tabs):
+            csv_file = nullcontext() if csv_files is None else open(csv_files[index], mode='w', newline='',
+                                                                    encoding='utf-8')
+            with csv_file:
+                csv_writer = None if csv_files is None else csv.writer(csv_file)
+                tables.append(read_excel_tab(workbook, tab_name, columns, csv_writer))
+    finally:
+        workbook.close()
+    return tables
+
+
+def round_cost(cost, digits=COST_DIGITS):
+    """
+    Round a cost for the csv report
 
-    # Read the Excel file with the 'openpyxl' engine and extract the specified tab
-    data_xls = pandas.read_excel(excel_file, sheet_name=tab_name, engine='openpyxl')
-    data_xls.to_csv(output_csv_file, encoding='utf-8', index=False)
+    :param cost: The cost, or None if it is not known
+    :param digits: The number of decimals to keep
+    :return: The rounded cost, or None if it is not known
+    """
+    return None if cost is None else round(cost, digits)
 
 
-import logging
+def write_report_file_to_csv(output_csv, hosts):
+    """
+    Write the priced host records to a csv file, followed by a row with the totals. The costs are kept at full
+    precision while pricing and are only rounded here, see COST_DIGITS.
+
+    :param output_csv: The name of the output csv file
+    :param hosts: A list of host records with costs, see find_aws_instance
+    """
+    assert output_csv and hosts
+    rows = []
+    for host in hosts:
+        cost_details = host['Cost Details']
+        total = round_cost(host['Total'])
+        rows.append((
+            host['VM'],
+            host['Instance Type'],
+            round_cost(host['Instance Cost']),
+            host['Storage'],
+            round_cost(host['Storage Cost']),
+            total,
+            round_cost(cost_details['onDemand']['Instance Cost'], HOURLY_COST_DIGITS),
+            round_cost(cost_details['1-year Reserved']['Instance Cost']),
+            round_cost(cost_details['3-year Reserved']['Instance Cost']),
+            total
+        ))
+
+    # Add up the costs that are known, a missing price counts as nothing
+    total_on_demand = round_cost(sum(row[6] for row in rows if row[6] is not None), HOURLY_COST_DIGITS)
+    total_one_year = round_cost(sum(row[7] for row in rows if row[7] is not None))
+    total_three_year = round_cost(sum(row[9] for row in rows if row[9] is not None))
+
+    with open(output_csv, mode='w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(REPORT_FIELDNAMES)
+        writer.writerows(rows)
+        writer.writerow(('Total', '', '', '', '', '', total_on_demand, total_one_year, total_three_year,
+                         total_three_year))
+
+
+def setup_logging(level=logging.INFO):
+    """
+    Configure the root logger. If it already has handlers only its level is changed, so calling this again still
+    takes effect. The AWS libraries stay at warnings, their debug output would bury the messages of this script.
+
+    :param level: The logging level
+    :return: The root logger
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
+    else:
+        root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.WARNING))
+    return root
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def main(input_file, output_file):
+def clear_pricing_caches():
+    """
+    Forget the prices and host shapes an earlier run in this process looked up, so that the pricing options and the
+    instance types of the next run take effect
+    """
+    for cached in (get_storage_cost, load_pricing_catalog, load_on_demand_table, load_ri_table, load_price_table,
+                   get_price_for_os_type, resolve_host_shape):
+        cached.cache_clear()
+
+
+def main(input_file, output_file, refresh=False, live=False, refresh_types=False, threads=32, export_csv=None):
     assert input_file and output_file
-    cpu_input_file = '/tmp/vcpu_input.csv'
-    disk_input_file = '/tmp/vdisk_input.csv'
-    
+    global refresh_pricing, live_pricing, type_index
+    clear_pricing_caches()
+    refresh_pricing = refresh
+    live_pricing = live
+    type_index = build_index(get_instance_type_table(fetch_instance_types(refresh=refresh_types)))
+
     # Initialize the Counter for invalid instance types
     invalid_instance_types_count = Counter()
 
-    # Convert the Excel tabs to CSV
+    # Read the Excel tabs, and optionally keep a CSV copy of them
     try:
-        excel_to_csv(input_file, CPU, cpu_input_file)
-        excel_to_csv(input_file, DISK, disk_input_file)
+        csv_files = None
+        if export_csv:
+            os.makedirs(export_csv, exist_ok=True)
+            csv_files = [os.path.join(export_csv, 'vcpu_input.csv'), os.path.join(export_csv, 'vdisk_input.csv')]
+        cpu_data, disk_data = read_excel_tabs(input_file, (CPU, HOST_COLUMNS), (DISK, DISK_COLUMNS),
+                                              csv_files=csv_files)
     except ValueError as e:
-        logging.error(f"Error converting Excel to CSV: {str(e)}")
+        logging.error(f"Error reading Excel file: {str(e)}")
         print("Please check if the required tabs 'vCPU' and 'vDisk' exist in the input Excel file.")
         return
     except Exception as e:
-        logging.error(f"Unexpected error during Excel to CSV conversion: {str(e)}")
+        logging.error(f"Unexpected error reading Excel file: {str(e)}")
         return
 
     # Load the host and disk records
     try:
-        hosts = load_host_records_from_csv(cpu_input_file)
-        disks = load_storage_records_from_csv(disk_input_file)
+        hosts = get_host_records(cpu_data)
+        disks = get_storage_table(disk_data)
     except Exception as e:
         logging.error(f"Error loading host or disk records: {str(e)}")
         print("Error: Unable to load host or disk records. Please check the input file format.")
         return
 
-    if not hosts or not disks:
+    if not hosts or disks is None or disks.empty:
         logging.warning("No hosts or disks loaded from input files.")
         print("Error: No host or disk records found. Please check the input file format.")
         return
+    disks_by_vm = get_disk_capacity_by_vm(disks)
+
+    # Fetch the prices of every candidate instance type in bulk
+    candidates = set()
+    for host in hosts:
+        candidates.update(get_correct_instance_size(host['CPUs'], host['RAM']))
+    os_types = {map_os_type(host['OS']) for host in hosts if host.get('OS')}
+    logging.info(f"Prefetching prices for {len(candidates)} instance types and {len(os_types)} OS types.")
+    prefetch_prices(candidates, os_types, threads)
+
+    # Resolve each distinct host shape and the storage price once, so the loop below only does the storage math
+    shapes = Counter((host['CPUs'], host['RAM'], host.get('OS')) for host in hosts)
+    logging.info(f"Resolving {len(shapes)} distinct host shapes.")
+    for shape, host_count in shapes.items():
+        _, invalid_instances = resolve_host_shape(*shape)
+        for instance_type in invalid_instances:
+            invalid_instance_types_count[instance_type] += host_count
+    try:
+        get_storage_cost()
+    except (ValueError, botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        # Not cached, so every host retries the lookup and is reported by the loop below if it still fails
+        logging.error(f"Error fetching the storage price: {str(e)}")
 
     # Print starting message
     total_hosts = len(hosts)
     logging.info(f"Starting processing of {total_hosts} hosts.")
     print(f"Starting processing of {total_hosts} hosts.")
 
-    # Process the host records and calculate costs
+    # Process the host records and calculate costs. Every price is in memory by now, so this is plain computation
+    # and the hosts are processed in the order of the input file.
     processed_host_records = []
     processed_count = 0
+    last_progress = 0.0
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {executor.submit(find_aws_instance, host, disks): host for host in hosts}
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                if result is not None:
-                    processed_host_records.append(result)
-                processed_count += 1
+    for host in hosts:
+        try:
+            result = process_host(host, disks_by_vm)
+            if result is not None:
+                processed_host_records.append(result)
+            processed_count += 1
+            # Only redraw the progress line a few times a second, and once more when all hosts are done
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL or processed_count == total_hosts:
+                last_progress = now
                 progress_percentage = processed_count / total_hosts * 100
                 print(f"Processing host {processed_count} of {total_hosts} ({progress_percentage:.2f}% complete)", flush=True, end='\r')
-            except Exception as e:
-                logging.error(f"Error processing host: {str(e)}")
+        except Exception as e:
+            logging.error(f"Error processing host: {str(e)}")
 
     # Print invalid instance types
     total_invalid_instances = sum(invalid_instance_types_count.values())
@@ -636,9 +1077,8 @@ def main(input_file, output_file):
     # Write the report to CSV
     logging.info("Processing complete. Writing to CSV.")
     print("\nProcessing complete. Writing to CSV.")
-    fieldnames = ['VM', 'Instance Type', 'Instance Cost', 'Storage', 'Storage Cost', 'Total', 'onDemand Cost', '1-Year Reserved', '3-Year Reserved', 'Total Cost']
     try:
-        write_report_file_to_csv(output_file, processed_host_records, disks, fieldnames)
+        write_report_file_to_csv(output_file, processed_host_records)
     except Exception as e:
         logging.error(f"Error writing CSV report: {str(e)}")
         print(f"Error writing CSV report: {str(e)}")
@@ -661,30 +1101,40 @@ def create_pdf_quote(output_pdf_file, host_records):
     pdf = SimpleDocTemplate(output_pdf_file, pagesize=letter)
     elements = []
 
-    # Logging
     logging.info("Starting PDF creation")
+    if not RL_ACCEL:
+        logging.info("The ReportLab C accelerator is not installed, install rl_accel to build the PDF quote faster")
+
+    # Collect the formatted table rows, the totals and the count of each instance type in a single pass over the
+    # hosts
+    instance_types_counts = Counter()
+    table_data = [["VM", "Instance Type", "onDemand Cost", "1-Year Reserved", "3-Year Reserved", "Total Cost"]]
+    total_on_demand = total_one_year = total_three_year = 0
     for host in host_records:
-        logging.info(f"Host data: {host}")
+        logging.debug(f"Host data: {host}")
+        cost_details = host["Cost Details"]
+        instance_type = host.get("Instance Type", "Unknown")
+        on_demand = cost_details["onDemand"].get("Instance Cost", 0) or 0
+        one_year = cost_details["1-year Reserved"].get("Instance Cost", 0) or 0
+        three_year = cost_details["3-year Reserved"].get("Instance Cost", 0) or 0
+        total = host.get("Total", 0) or 0
+        instance_types_counts[instance_type] += 1
+        table_data.append([host.get("VM", "Unknown"), instance_type,
+                           f"{on_demand:,.2f}", f"{one_year:,.2f}", f"{three_year:,.2f}", f"{total:,.2f}"])
+        total_on_demand += on_demand
+        total_one_year += one_year
+        total_three_year += total
 
     # Title
     title = "AHEAD & AWS Migration Quote"
-    title_style = getSampleStyleSheet()['Title']
-    title_style.alignment = 1  # Align the title to the right
-    elements.append(Paragraph(title, title_style))
-
-    # Calculate the count of each instance type
-    instance_types_counts = Counter(host.get("Instance Type", "Unknown") for host in host_records)
-    total_count = sum(instance_types_counts.values())
+    elements.append(Paragraph(title, PDF_TITLE_STYLE))
 
     # Filter instance types, grouping those under a certain percentage into "Other"
     threshold_percentage = 5  # You can adjust this threshold
-    other_count = 0
-    filtered_counts = {}
-    for instance_type, count in instance_types_counts.items():
-        if count / total_count * 100 < threshold_percentage:
-            other_count += count
-        else:
-            filtered_counts[instance_type] = count
+    threshold = len(host_records) * threshold_percentage / 100
+    filtered_counts = {instance_type: count for instance_type, count in instance_types_counts.items()
+                       if count >= threshold}
+    other_count = len(host_records) - sum(filtered_counts.values())
 
     if other_count > 0:
         filtered_counts["Other"] = other_count
@@ -703,14 +1153,7 @@ def create_pdf_quote(output_pdf_file, host_records):
     elements.append(drawing)
     elements.append(Spacer(1, 50))  # Add more space after the chart to accommodate it
 
-    # Initialize the totals
-    total_on_demand = total_one_year = total_three_year = 0
-
     # Projected Costs
-    for host in host_records:
-        total_one_year += host["Cost Details"]["1-year Reserved"].get("Instance Cost", 0) or 0
-        total_three_year += host.get("Total", 0) or 0
-
     projected_costs_data = [
         ("Projected Costs (USD)", "1-Year", "3-Year"),
         ("Total", "{:,.2f}".format(total_one_year), "{:,.2f}".format(total_three_year))
@@ -720,22 +1163,7 @@ def create_pdf_quote(output_pdf_file, host_records):
     elements.append(Spacer(1, 20))  # Add some space after the projected costs
     elements.append(PageBreak())  # Add a page break after projected costs
 
-    # Create a table to display the host records
-    table_data = [["VM", "Instance Type", "onDemand Cost", "1-Year Reserved", "3-Year Reserved", "Total Cost"]]
-
-    for host in host_records:
-        row = [
-            host.get("VM", "Unknown"),
-            host.get("Instance Type", "Unknown"),
-            "{:,.2f}".format(host["Cost Details"]["onDemand"].get("Instance Cost", 0) or 0),
-            "{:,.2f}".format(host["Cost Details"]["1-year Reserved"].get("Instance Cost", 0) or 0),
-            "{:,.2f}".format(host["Cost Details"]["3-year Reserved"].get("Instance Cost", 0) or 0),
-            "{:,.2f}".format(host.get("Total", 0) or 0)
-        ]
-        table_data.append(row)
-        total_on_demand += host["Cost Details"]["onDemand"].get("Instance Cost", 0) or 0
-
-    # Add totals row
+    # Add totals row to the host table
     table_data.append([
         "Total",
         "",
@@ -744,33 +1172,54 @@ def create_pdf_quote(output_pdf_file, host_records):
         "{:,.2f}".format(total_three_year),
         "{:,.2f}".format(total_three_year)
     ])
-    
-    # Define column widths (in points)
-    col_widths = (60, 120, 80, 100, 100, 80)
-
-    # Create table with specific column widths
-    table = Table(table_data, colWidths=col_widths)
-
-    table_style = TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -2), colors.beige),  # Exclude the last row from the beige background
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),  # Highlight the total row
-        ('FONTSIZE', (0, 0), (-1, -1), 10)  # Adjust font size
-    ])
 
-    table.setStyle(table_style)
+    # Add the table as one table per page, each starting with the header row. Each time ReportLab splits a table at
+    # the end of a page it measures all the remaining rows again, which makes laying out one long table quadratic
+    # in the number of hosts.
+    header, rows = table_data[0], table_data[1:]
+    page_rows = int((pdf.height - 2 * PDF_FRAME_PADDING - HOST_TABLE_HEADER_HEIGHT) // HOST_TABLE_ROW_HEIGHT)
+    for start in range(0, len(rows), page_rows):
+        chunk = [header] + rows[start:start + page_rows]
+        chunk_style = HOST_TABLE_STYLE + HOST_TABLE_HEADER_STYLE
+        row_heights = [HOST_TABLE_HEADER_HEIGHT] + [HOST_TABLE_ROW_HEIGHT] * (len(chunk) - 1)
+        if start + page_rows >= len(rows):
+            chunk_style += HOST_TABLE_TOTAL_STYLE
+
+        # Create table with specific column widths. The header is repeated should a table still need to be split.
+        table = Table(chunk, colWidths=HOST_TABLE_COL_WIDTHS, rowHeights=row_heights, repeatRows=1)
+        table.setStyle(TableStyle(chunk_style))
+        elements.append(table)  # Add the table to the elements list
 
-    elements.append(table)  # Add the table to the elements list
     pdf.build(elements)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Input/Output for AWS pricing')
     parser.add_argument('--input_file', default=None, help='input file name')
     parser.add_argument('--output_file', default=None, help='output file name')
+    parser.add_argument('--refresh-pricing', action='store_true', help='ignore cached prices and query AWS again')
+    parser.add_argument('--live-pricing', action='store_true', help='query AWS instead of the local price catalog')
+    parser.add_argument('--refresh-types', action='store_true',
+                        help='ignore the cached instance type list and query AWS again')
+    parser.add_argument('--threads', type=int, default=32, help='number of price tables to download concurrently')
+    parser.add_argument('--export-csv', default=None, metavar='DIR',
+                        help='also write the vCPU and vDisk tabs as CSV files to this directory')
+    parser.add_argument('--build-pricing-catalog', action='store_true',
+                        help='download the current prices into the local price catalog and exit')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='profile the run, write the cProfile stats to this file and print the top entries')
+    parser.add_argument('--verbose', action='store_true', help='also log debug messages, such as every host record')
     args = parser.parse_args()
-    main(args.input_file, args.output_file)
\ No newline at end of file
+    setup_logging(logging.DEBUG if args.verbose else logging.INFO)
+    if args.build_pricing_catalog:
+        count = build_pricing_catalog(PRICING_CATALOG_FILE)
+        print(f"Wrote {count} prices to {PRICING_CATALOG_FILE}")
+    else:
+        run = partial(main, args.input_file, args.output_file, args.refresh_pricing, args.live_pricing,
+                      args.refresh_types, args.threads, args.export_csv)
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.runcall(run)
+            profiler.dump_stats(args.profile)
+            pstats.Stats(args.profile).sort_stats('cumulative').print_stats(20)
+        else:
+            run()
\ No newline at end of file